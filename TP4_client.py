@@ -10,6 +10,10 @@ import sys
 import glosocket
 import gloutils
 
+# Codec JSON compact partagé, construit une seule fois.
+_ENC = json.JSONEncoder(separators=(',', ':')).encode
+_DEC = json.JSONDecoder().decode
+
 
 class Client:
     """Client pour le serveur mail @glo2000.ca."""
@@ -20,6 +24,9 @@ class Client:
 
         Prépare un attribut `_username` pour stocker le nom d'utilisateur
         courant. Laissé vide quand l'utilisateur n'est pas connecté.
+
+        Prépare les tables `_auth_menu` et `_use_menu` associant chaque
+        option des menus à sa méthode.
         """
         try:
             self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -29,6 +36,9 @@ class Client:
             sys.exit(1)
 
         self._username = ""
+        self._auth_menu = {'1': self._register, '2': self._login, '3': self._quit}
+        self._use_menu = {'1': self._read_email, '2': self._send_email,
+                          '3': self._check_stats, '4': self._logout}
 
     def _register(self) -> None:
         """
@@ -43,11 +53,11 @@ class Client:
         password = getpass.getpass("Entrez votre mot de passe:", None)
 
         message = gloutils.AuthPayload(username=username, password=password)
-        data = json.dumps(gloutils.GloMessage(header=gloutils.Headers.AUTH_REGISTER, payload=message))
+        data = _ENC(gloutils.GloMessage(header=gloutils.Headers.AUTH_REGISTER, payload=message))
         glosocket.send_msg(dest_soc=self._socket, message=data)
 
         data = glosocket.recv_msg(self._socket)
-        header = json.loads(data)["header"]
+        header = _DEC(data)["header"]
 
         if header == gloutils.Headers.OK:
             self._username = username
@@ -71,11 +81,11 @@ class Client:
         password = getpass.getpass("Entrez votre mot de passe:", None)
 
         message = gloutils.AuthPayload(username=username, password=password)
-        data = json.dumps(gloutils.GloMessage(header=gloutils.Headers.AUTH_LOGIN, payload=message))
+        data = _ENC(gloutils.GloMessage(header=gloutils.Headers.AUTH_LOGIN, payload=message))
         glosocket.send_msg(dest_soc=self._socket, message=data)
 
         data = glosocket.recv_msg(self._socket)
-        header = json.loads(data)["header"]
+        header = _DEC(data)["header"]
 
         match header:
             case gloutils.Headers.OK:
@@ -90,7 +100,7 @@ class Client:
         socket du client.
         """
         try:
-            data = json.dumps(gloutils.GloMessage(header=gloutils.Headers.BYE))
+            data = _ENC(gloutils.GloMessage(header=gloutils.Headers.BYE))
             glosocket.send_msg(dest_soc=self._socket, message=data)
             self._socket.close()
 
@@ -111,20 +121,27 @@ class Client:
         retourner au menu principal.
         """
         try:
-            data = json.dumps(gloutils.GloMessage(header=gloutils.Headers.INBOX_READING_REQUEST))
+            data = _ENC(gloutils.GloMessage(header=gloutils.Headers.INBOX_READING_REQUEST))
             glosocket.send_msg(dest_soc=self._socket, message=data)
 
-            email_list = glosocket.recv_msg(source_soc=self._socket)
+            reponse = _DEC(glosocket.recv_msg(source_soc=self._socket))
+            email_list = reponse["payload"]["email_list"]
+            if not email_list:
+                print("Aucun courriel à lire.")
+                return
             for x in email_list:
                 print(x)
 
             selection = int(input("Selection: "))
             couriel = gloutils.EmailChoicePayload(choice=selection)
 
-            data = json.dumps(gloutils.GloMessage(header=gloutils.Headers.INBOX_READING_CHOICE, payload=couriel))
+            data = _ENC(gloutils.GloMessage(header=gloutils.Headers.INBOX_READING_CHOICE, payload=couriel))
             glosocket.send_msg(dest_soc=self._socket, message=data)
 
             couriel_response = glosocket.recv_msg(source_soc=self._socket)
+            if _DEC(couriel_response).get("header") == gloutils.Headers.ERROR:
+                print("Choix de courriel invalide.")
+                return
             print(couriel_response)
 
         except glosocket.GLOSocketError:
@@ -139,7 +156,8 @@ class Client:
 
         La saisie du corps se termine par un point seul sur une ligne.
 
-        Transmet ces informations avec l'entête `EMAIL_SENDING`.
+        Transmet ces informations avec l'entête `EMAIL_SENDING` et signale
+        un échec de livraison.
         """
         sender = f"{self._username}@glo2000.ca"
         destination = input("Destinataire: ")
@@ -147,20 +165,29 @@ class Client:
         date = str(gloutils.get_current_utc_time())
 
         print("Corps du message: (entrez '.' sur une ligne seule pour terminer)")
-        body = ""
-        buffer = ""
-
-        while buffer != ".\n":
-            body += buffer
-            buffer = input() + '\n'
+        lignes = []
+        readline = sys.stdin.readline
+
+        # Les lignes sont jointes une seule fois à la fin
+        for ligne in iter(readline, ""):
+            if ligne.rstrip("\r\n") == ".":
+                break
+            if not ligne.endswith("\n"):
+                ligne += "\n"
+            lignes.append(ligne)
+        body = "".join(lignes)
 
         try:
             message = gloutils.EmailContentPayload(
                 sender=sender, destination=destination, subject=subject, date=date, content=body
             )
-            data = json.dumps(gloutils.GloMessage(header=gloutils.Headers.EMAIL_SENDING, payload=message))
+            data = _ENC(gloutils.GloMessage(header=gloutils.Headers.EMAIL_SENDING, payload=message))
             glosocket.send_msg(dest_soc=self._socket, message=data)
 
+            reponse = _DEC(glosocket.recv_msg(self._socket))
+            if reponse["header"] == gloutils.Headers.ERROR:
+                print("Le courriel n'a pas pu être livré.")
+
         except glosocket.GLOSocketError:
             print("Erreur lors de l'envoi du courriel:", glosocket.GLOSocketError)
 
@@ -170,13 +197,13 @@ class Client:
 
         Affiche les statistiques à l'aide du gabarit `STATS_DISPLAY`.
         """
-        count = int(input("Nombre de courriels: "))
-        size = int(input("Taille du dossier: "))
         try:
-            stats = gloutils.StatsPayload(count=count, size=size)
-            data = json.dumps(gloutils.GloMessage(header=gloutils.Headers.STATS_REQUEST, payload=stats))
+            data = _ENC(gloutils.GloMessage(header=gloutils.Headers.STATS_REQUEST))
             glosocket.send_msg(dest_soc=self._socket, message=data)
 
+            stats = _DEC(glosocket.recv_msg(source_soc=self._socket))["payload"]
+            print(gloutils.STATS_DISPLAY.format(count=stats["count"], size=stats["size"]))
+
         except glosocket.GLOSocketError:
             print("Erreur lors de la demande de statistiques:", glosocket.GLOSocketError)
 
@@ -186,12 +213,16 @@ class Client:
         Met à jour l'attribut `_username`.
         """
         try:
-            data = json.dumps(gloutils.GloMessage(header=gloutils.Headers.AUTH_LOGOUT))
+            data = _ENC(gloutils.GloMessage(header=gloutils.Headers.AUTH_LOGOUT))
             glosocket.send_msg(dest_soc=self._socket, message=data)
             self._username = ""
         except glosocket.GLOSocketError as e:
             print(f"Erreur lors de la déconnexion : {e}")
 
+    def _invalid(self) -> None:
+        """Signale une option de menu invalide."""
+        print("Option invalide. Veuillez choisir une option valide.")
+
     def run(self) -> None:
         """Point d'entrée du client."""
         should_quit = False
@@ -200,29 +231,11 @@ class Client:
             if not self._username:
                 print(gloutils.CLIENT_AUTH_CHOICE)
                 option = input("Entrez votre choix [1-3]: ")
-                match option:
-                    case '1':
-                        self._register()
-                    case '2':
-                        self._login()
-                    case '3':
-                        self._quit()
-                    case _:
-                        print("Option invalide. Veuillez choisir une option valide.")
+                (self._auth_menu.get(option) or self._invalid)()
             else:
                 print(gloutils.CLIENT_USE_CHOICE)
                 option = input("Entrez votre choix [1-4]: ")
-                match option:
-                    case '1':
-                        self._read_email()
-                    case '2':
-                        self._send_email()
-                    case '3':
-                        self._check_stats()
-                    case '4':
-                        self._logout()
-                    case _:
-                        print("Option invalide. Veuillez choisir une option valide.")
+                (self._use_menu.get(option) or self._invalid)()
 
 
 def _main() -> int:
@@ -1,49 +1,290 @@
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import email
 from email.message import EmailMessage
+import functools
 import hashlib
 import hmac
 import json
 import os
-import select
+import selectors
+import signal
 import smtplib
 import socket
+import struct
 import sys
+import threading
+import time
+import uuid
 import re
 import pathlib
 import glosocket
 import gloutils
 import os.path
+from typing import Any, Callable
+
+# Shared compact JSON codec, built once. Output stays ASCII-escaped so that
+# lone surrogates decoded from a client's \u escapes can always be written.
+_ENC = json.JSONEncoder(separators=(',', ':')).encode
+_DECODER = json.JSONDecoder()
+_DEC = _DECODER.decode
+_RAW_DEC = _DECODER.raw_decode
+
+# Linux only: holds partial segments until the cork is removed.
+_TCP_CORK = getattr(socket, "TCP_CORK", None)
+_MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", None)
+
+# Framing used by glosocket: a message is prefixed by its length.
+_LENGTH = struct.Struct("!I")
+_RECV_BUF_SIZE = 65536
+# Largest message accepted from a client, the sender is dropped beyond it.
+_MAX_MSG_SIZE = 16 * 1024 * 1024
+
+# Constant responses, encoded once and reused by _encode.
+_OK_BYTES = _ENC(gloutils.GloMessage(header=gloutils.Headers.OK)).encode('utf-8')
+_ERR_BYTES = _ENC(gloutils.GloMessage(header=gloutils.Headers.ERROR)).encode('utf-8')
+
+_DATA_DIR = pathlib.Path(gloutils.SERVER_DATA_DIR)
+_LOST_DIR = pathlib.Path(gloutils.SERVER_LOST_DIR)
+
+# Account validation: a username needs a letter, a password more than 9 characters.
+_USER_RE = re.compile(r"[A-Za-z]").search
+_MIN_PW_LEN = 9
+
+# scrypt cost parameters for stored passwords.
+_SCRYPT_N = 16384
+_SCRYPT_R = 8
+_SCRYPT_P = 1
+_SALT_LEN = 16
+_KEY_LEN = 32
+_CREDENTIALS_CACHE_SIZE = 256
+
+# Pooled SMTP connections are reopened past this age, in seconds.
+_SMTP_MAX_AGE = 100
+_SMTP_WORKERS = 8
+
+# Messages carrying only a header, e.g. `{"header": 3}`.
+_HEADER_ONLY_RE = re.compile(r'\{\s*"header"\s*:\s*(\d+)\s*\}')
+_HEADER_ONLY_MAX_LEN = 32
+# Start of a message with a payload, as sent by the client.
+_PAYLOAD_PREFIX_RE = re.compile(r'\{\s*"header"\s*:\s*(\d+)\s*,\s*"payload"\s*:\s*')
+_NO_PAYLOAD_HEADERS = frozenset({gloutils.Headers.BYE,
+                                 gloutils.Headers.AUTH_LOGOUT,
+                                 gloutils.Headers.INBOX_READING_REQUEST,
+                                 gloutils.Headers.STATS_REQUEST})
+# Requests accepted from a socket with no logged user.
+_UNAUTHENTICATED_HEADERS = frozenset({gloutils.Headers.AUTH_REGISTER,
+                                      gloutils.Headers.AUTH_LOGIN,
+                                      gloutils.Headers.AUTH_LOGOUT,
+                                      gloutils.Headers.BYE})
+
+
+def _set_cork(soc: socket.socket, enabled: bool) -> None:
+    """Sets or removes `TCP_CORK` on the socket when the platform supports it."""
+    if _TCP_CORK is not None:
+        soc.setsockopt(socket.IPPROTO_TCP, _TCP_CORK, int(enabled))
+
+
+def _encode(message: gloutils.GloMessage) -> bytes:
+    """Encodes a message, reusing the pre-encoded constant responses."""
+    if "payload" not in message:
+        if message.get("header") == gloutils.Headers.OK:
+            return _OK_BYTES
+        if message.get("header") == gloutils.Headers.ERROR:
+            return _ERR_BYTES
+    return _ENC(message).encode('utf-8')
+
+
+def _has_fields(payload: Any, **types: type) -> bool:
+    """Checks that the payload is a dict whose given fields have the expected types."""
+    return isinstance(payload, dict) and all(isinstance(payload.get(nom), attendu)
+                                             for nom, attendu in types.items())
+
+
+def _new_email_filename() -> str:
+    """Returns a unique file name for a stored email, sortable by arrival."""
+    return f"{time.time_ns()}-{uuid.uuid4().hex}"
+
+
+def _hash_password(password: str, salt: bytes) -> bytes:
+    """Derives the stored key of a password with scrypt."""
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt,
+                          n=_SCRYPT_N, r=_SCRYPT_R, p=_SCRYPT_P, dklen=_KEY_LEN)
+
+
+@functools.lru_cache(maxsize=64)
+def _parse_header_only(donn: str) -> gloutils.Headers | None:
+    """
+    Returns the header of a message expecting no payload without a full
+    `_DEC`, or None if the message must be parsed normally.
+    """
+    match = _HEADER_ONLY_RE.fullmatch(donn)
+    if match is None:
+        return None
+    header = int(match.group(1))
+    if header not in _NO_PAYLOAD_HEADERS:
+        return None
+    return gloutils.Headers(header)
+
+
+def _split_message(donn: str) -> tuple[int, Any, str | None]:
+    """
+    Decodes a message into its header, its payload and the undecoded text
+    of the payload.
+
+    The text of the payload is None when the message is not laid out as
+    `{"header": ..., "payload": ...}`.
+    """
+    match = _PAYLOAD_PREFIX_RE.match(donn)
+    if match is not None:
+        try:
+            payload, end = _RAW_DEC(donn, match.end())
+        except ValueError:
+            pass
+        else:
+            if donn[end:].strip() == "}":
+                return int(match.group(1)), payload, donn[match.end():end]
+    dico = _DEC(donn)
+    return dico["header"], dico.get("payload"), None
+
+
+class _RecvBuffer:
+    """
+    Receive buffer of a client socket, reused for all its messages.
+
+    Data is received in place with `recv_into` and the length-prefixed
+    messages are decoded straight from the buffer, so receiving does not
+    allocate intermediate `bytes` objects.
+    """
+    __slots__ = ("buf", "length")
+
+    def __init__(self) -> None:
+        self.buf = bytearray(_RECV_BUF_SIZE)
+        self.length = 0
+
+    def fill(self, soc: socket.socket) -> bool:
+        """
+        Receives what the socket has ready, blocking only on the first read.
+
+        Without `MSG_DONTWAIT`, a single read is made per call. Returns False
+        if the other socket is closed.
+        """
+        flags = 0
+        while self.length < len(self.buf):
+            try:
+                n = soc.recv_into(memoryview(self.buf)[self.length:], 0, flags)
+            except BlockingIOError:
+                break
+            if n == 0:
+                return False
+            self.length += n
+            if _MSG_DONTWAIT is None:
+                break
+            flags = _MSG_DONTWAIT
+        return True
+
+    def pop_messages(self) -> list[str]:
+        """
+        Decodes the complete messages in the buffer and slides the incomplete
+        rest to its start.
+
+        When that rest fills the buffer, the buffer is doubled, up to the size
+        of the message, so that it only grows as the data actually arrives.
+        Raises GLOSocketError if a message is longer than `_MAX_MSG_SIZE`.
+        """
+        messages = []
+        offset = 0
+        with memoryview(self.buf) as view:
+            while self.length - offset >= _LENGTH.size:
+                size, = _LENGTH.unpack_from(self.buf, offset)
+                if size > _MAX_MSG_SIZE:
+                    raise glosocket.GLOSocketError("The message is too long.")
+                end = offset + _LENGTH.size + size
+                if end > self.length:
+                    break
+                messages.append(str(view[offset + _LENGTH.size:end], 'utf-8'))
+                offset = end
+            rest = self.length - offset
+            if offset and rest:
+                view[:rest] = view[offset:self.length]
+        self.length = rest
+
+        if rest == len(self.buf):
+            needed = _LENGTH.size + _LENGTH.unpack_from(self.buf)[0]
+            self.buf.extend(bytes(min(len(self.buf), needed - len(self.buf))))
+        elif rest < _LENGTH.size and len(self.buf) > _RECV_BUF_SIZE:
+            del self.buf[_RECV_BUF_SIZE:]
+        return messages
 
 
 class Server:
     """Serveur mail @glo2000.ca."""
 
-    def __init__(self) -> None:
+    def __init__(self, reuse_port: bool = False) -> None:
         """
         Initializes the server by setting up the `_server_socket` and putting it in listening mode.
 
         Initializes the following attributes:
         - `_client_socs`: a list of client sockets.
-        - `_logged_users`: a dictionary associating each client socket with a username.
+        - `_logged_users`: a dictionary associating each username with its client socket.
+        - `_sock_to_user`: the reverse of `_logged_users`, for O(1) lookups by socket.
+        - `_sel`: the selector (epoll/kqueue where available) watching the server
+          socket, tagged "accept", and every client socket, with its `_RecvBuffer`.
+        - `_user_dirs`: the data folder of each logged user.
+        - `_inbox_cache`: the inbox index entries last read for each user folder.
+        - `_credentials`: an LRU cache of the `(salt, key)` stored for each username.
+        - `_smtp_pool`: the open SMTP connection and its creation time for each
+          relay thread and host.
+        - `_smtp_pool_executor`: the threads relaying external emails off the main loop.
+        - `_dispatch`: the handler of each request header.
+        - `_out`: the responses pending for the client socket being handled.
+        - `_raw_payload`: the undecoded payload of the message being handled.
 
         Ensures that the server data folders exist.
+
+        With `reuse_port`, the server socket uses `SO_REUSEPORT` so that
+        several server processes can listen on the same port, the kernel
+        balancing the incoming connections between them. Otherwise, binding
+        fails if the port is already used, e.g. by another server.
         """
-        # Ensure the server data directories exist
-        if not os.path.exists(gloutils.SERVER_DATA_DIR):
-            os.mkdir(gloutils.SERVER_DATA_DIR)
-        if not os.path.exists(gloutils.SERVER_LOST_DIR):
-            os.mkdir(gloutils.SERVER_LOST_DIR)
+        # Ensure the server data directories exist, other processes may create them concurrently
+        os.makedirs(gloutils.SERVER_DATA_DIR, exist_ok=True)
+        os.makedirs(gloutils.SERVER_LOST_DIR, exist_ok=True)
 
         # Initialize attributes
         self._client_socs = []
-        self._logged_users = {}
+        self._logged_users: dict[str, socket.socket] = {}
+        self._sock_to_user: dict[socket.socket, str] = {}
+        self._user_dirs: dict[str, pathlib.Path] = {}
+        self._inbox_cache: dict[pathlib.Path, tuple[tuple[int, int], list[dict]]] = {}
+        self._sel = selectors.DefaultSelector()
+        self._credentials: collections.OrderedDict[str, tuple[bytes, bytes]] = collections.OrderedDict()
+        self._smtp_pool: dict[tuple[int, str], tuple[smtplib.SMTP, float]] = {}
+        self._smtp_lock = threading.Lock()
+        self._smtp_pool_executor = ThreadPoolExecutor(max_workers=_SMTP_WORKERS)
+        self._out = bytearray()
+        self._raw_payload: str | None = None
+        self._dispatch: dict[int, Callable[[socket.socket, Any], bytes | None]] = {
+            gloutils.Headers.AUTH_REGISTER: self._h_register,
+            gloutils.Headers.AUTH_LOGIN: self._h_login,
+            gloutils.Headers.AUTH_LOGOUT: self._h_logout,
+            gloutils.Headers.BYE: self._h_bye,
+            gloutils.Headers.INBOX_READING_REQUEST: self._h_inbox_request,
+            gloutils.Headers.INBOX_READING_CHOICE: self._h_inbox_choice,
+            gloutils.Headers.EMAIL_SENDING: self._h_email_sending,
+            gloutils.Headers.STATS_REQUEST: self._h_stats,
+        }
 
         try:
             # Create and configure the server socket
             self._server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                self._server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self._server_socket.bind(("127.0.0.1", gloutils.APP_PORT))
             self._server_socket.listen()
+            self._sel.register(self._server_socket, selectors.EVENT_READ, data="accept")
         except glosocket.GLOSocketError:
             print("Error initializing the server socket. Check if the port is available.")
 
@@ -52,40 +293,48 @@ class Server:
         Closes all residual connections.
 
         Iterates through all client sockets in `_client_socs` and closes each socket.
-        Finally, closes the server socket.
+        Waits for the pending relays, then closes the pooled SMTP connections.
+        Finally, closes the server socket and the selector.
         """
         # Close all client sockets
         for client_soc in self._client_socs:
             client_soc.close()
 
+        # Finish the pending relays and close the pooled SMTP connections
+        self._smtp_pool_executor.shutdown(wait=True)
+        for key in list(self._smtp_pool):
+            self._drop_smtp(key)
+
         # Close the server socket
         self._server_socket.close()
+        self._sel.close()
 
     def _accept_client(self) -> None:
         """
         Accepts a new client.
 
         Accepts a new client connection using the server socket.
-        The new client socket is added to the list of client sockets (_client_socs).
+        The new client socket is added to the list of client sockets (_client_socs)
+        and registered with the selector.
         """
         client_soc, address = self._server_socket.accept()
         self._client_socs.append(client_soc)
+        self._sel.register(client_soc, selectors.EVENT_READ, data=_RecvBuffer())
 
     def _remove_client(self, client_soc: socket.socket) -> None:
         """
         Removes the client from data structures and closes its connection.
 
-        Iterates through the logged users to find and remove the client socket.
-        Removes the client socket from the list of client sockets (_client_socs).
+        Logs out the user associated with the client socket, if any.
+        Removes the client socket from the list of client sockets (_client_socs)
+        and from the selector.
         Closes the client socket.
         """
-        # Find and remove the client from logged users
-        for nom, s in self._logged_users.items():
-            if client_soc == s:
-                self._logged_users.pop(nom)
+        self._logout(client_soc)
 
         # Remove the client socket from the list of client sockets
         self._client_socs.remove(client_soc)
+        self._sel.unregister(client_soc)
 
         # Close the client socket
         client_soc.close()
@@ -94,22 +343,17 @@ class Server:
         """
         Disconnects a user.
 
-        Finds the username associated with the given client socket and removes
-        the user from the logged users dictionary.
+        Removes the user associated with the given client socket from the
+        logged users dictionaries.
 
         Parameters:
         - client_soc (socket.socket): The client socket to disconnect.
         """
-        nom = None
-
-        # Iterate through logged users to find the username associated with the client socket
-        for key, value in self._logged_users.items():
-            if value == client_soc:
-                nom = key
-
-        # Remove the user from the logged users dictionary
+        nom = self._sock_to_user.pop(client_soc, None)
         if nom is not None:
-            del self._logged_users[nom]
+            self._logged_users.pop(nom, None)
+            user_dir = self._user_dirs.pop(nom, None)
+            self._inbox_cache.pop(user_dir, None)
 
     def _create_account(self, client_soc: socket.socket,
                         payload: gloutils.AuthPayload
@@ -129,42 +373,60 @@ class Server:
         - gloutils.GloMessage: Success message or error message.
         """
 
+        if not _has_fields(payload, username=str, password=str):
+            return gloutils.GloMessage(header=gloutils.Headers.ERROR)
         username = payload["username"]
         password = payload["password"]
-        user_valid = False
-        password_valid = False
+
+        path = _DATA_DIR / username
 
         # Check if the username is already taken
-        for user_index in self._logged_users:
-            if username.lower() == self._logged_users[user_index].lower():
+        for logged_username in self._logged_users:
+            if username.lower() == logged_username.lower():
                 return gloutils.GloMessage(header=gloutils.Headers.ERROR)
 
-        # Check if the username contains at least one letter
-        if re.search(r"[a-zA-Z]", username):
-            user_valid = True
-
-        # Check if the password length is greater than 9
-        if len(password) > 9:
-            password_valid = True
+        # The username needs a letter and the password more than _MIN_PW_LEN characters
+        if not (_USER_RE(username) and len(password) > _MIN_PW_LEN):
+            return gloutils.GloMessage(header=gloutils.Headers.ERROR)
 
-        # If credentials are not valid, send an error message
-        if not (password_valid and user_valid):
-            return glosocket.send_msg(client_soc, json.dumps(gloutils.GloMessage(header=gloutils.Headers.ERROR)))
+        # The username must name a single folder directly in the data folder
+        if path.parent != _DATA_DIR:
+            return gloutils.GloMessage(header=gloutils.Headers.ERROR)
 
-        # Add the user to the logged users dictionary
-        self._logged_users[username] = client_soc
+        # Derive the password key with scrypt and a per-user salt
+        salt = os.urandom(_SALT_LEN)
+        key = _hash_password(password, salt)
 
-        # Hash the password using SHA-3 224
-        hashed_password = hashlib.sha3_224(password.encode('utf-8')).hexdigest()
+        # Creating the user's folder also checks atomically that the account
+        # does not exist, including one registered by another server process.
+        # Other failures come from names the file system refuses
+        try:
+            path.mkdir()
+        except (OSError, ValueError):
+            return gloutils.GloMessage(header=gloutils.Headers.ERROR)
 
-        # Create the user's folder and store the hashed password
-        path = os.path.join(gloutils.SERVER_DATA_DIR, username)
-        if not os.path.exists(path):
-            os.mkdir(path)
-            with open(os.path.join(path, gloutils.PASSWORD_FILENAME), "a") as f:
-                f.write(hashed_password)
+        # Store the raw salt and key, readable by the server only. Without
+        # it the folder would block the username, so it is removed on failure
+        chemin_pass = path / gloutils.PASSWORD_FILENAME
+        try:
+            fd = os.open(chemin_pass, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                os.write(fd, salt + key)
+            finally:
+                os.close(fd)
+        except OSError:
+            chemin_pass.unlink(missing_ok=True)
+            path.rmdir()
+            return gloutils.GloMessage(header=gloutils.Headers.ERROR)
+        self._cache_credentials(username, salt, key)
+
+        # Add the user to the logged users dictionary, replacing the socket's previous user
+        self._logout(client_soc)
+        self._logged_users[username] = client_soc
+        self._sock_to_user[client_soc] = username
+        self._user_dirs[username] = path
 
-        return glosocket.send_msg(client_soc, json.dumps(gloutils.GloMessage(header=gloutils.Headers.OK)))
+        return gloutils.GloMessage(header=gloutils.Headers.OK)
 
     def _login(self, client_soc: socket.socket, payload: gloutils.AuthPayload
                ) -> gloutils.GloMessage:
@@ -182,21 +444,135 @@ class Server:
         - gloutils.GloMessage: Success message or error message.
         """
 
+        if not _has_fields(payload, username=str, password=str):
+            return gloutils.GloMessage(header=gloutils.Headers.ERROR)
         username = payload["username"]
         password = payload["password"]
 
-        # Check if the username exists in the logged users dictionary
-        if username in self._logged_users:
-            # Retrieve the associated socket
-            existing_socket = self._logged_users[username]
+        credentials = self._get_credentials(username)
+        if credentials is None:
+            return gloutils.GloMessage(header=gloutils.Headers.ERROR)
 
-            # Check if the provided socket matches the one associated with the username
-            if existing_socket == client_soc:
-                return glosocket.send_msg(client_soc, json.dumps(gloutils.GloMessage(header=gloutils.Headers.OK)))
-            else:
-                return glosocket.send_msg(client_soc, json.dumps(gloutils.GloMessage(header=gloutils.Headers.ERROR)))
-        else:
-            return glosocket.send_msg(client_soc, json.dumps(gloutils.GloMessage(header=gloutils.Headers.ERROR)))
+        # Compare the derived key in constant time
+        salt, key = credentials
+        if not hmac.compare_digest(key, _hash_password(password, salt)):
+            return gloutils.GloMessage(header=gloutils.Headers.ERROR)
+
+        # The account cannot be used from two sockets at once
+        existing_socket = self._logged_users.get(username)
+        if existing_socket is not None and existing_socket != client_soc:
+            return gloutils.GloMessage(header=gloutils.Headers.ERROR)
+
+        self._logout(client_soc)
+        self._logged_users[username] = client_soc
+        self._sock_to_user[client_soc] = username
+        self._user_dirs[username] = _DATA_DIR / username
+        return gloutils.GloMessage(header=gloutils.Headers.OK)
+
+    def _cache_credentials(self, username: str, salt: bytes, key: bytes) -> None:
+        """Stores the credentials of a user, evicting the least recently used ones."""
+        self._credentials[username] = (salt, key)
+        self._credentials.move_to_end(username)
+        if len(self._credentials) > _CREDENTIALS_CACHE_SIZE:
+            self._credentials.popitem(last=False)
+
+    def _get_credentials(self, username: str) -> tuple[bytes, bytes] | None:
+        """
+        Retrieves the salt and key stored for a user, or None if the account
+        does not exist.
+
+        The password file is only read when the user is not in the cache.
+        """
+        credentials = self._credentials.get(username)
+        if credentials is not None:
+            self._credentials.move_to_end(username)
+            return credentials
+
+        try:
+            with open(_DATA_DIR / username / gloutils.PASSWORD_FILENAME, "rb") as f:
+                donnees = f.read()
+        except OSError:
+            return None
+        if len(donnees) != _SALT_LEN + _KEY_LEN:
+            return None
+        salt, key = donnees[:_SALT_LEN], donnees[_SALT_LEN:]
+
+        self._cache_credentials(username, salt, key)
+        return salt, key
+
+    def _read_inbox_index(self, user_dir: pathlib.Path) -> list[dict]:
+        """
+        Reads the inbox index in a user's folder, from most recent to oldest.
+
+        Each entry holds the `file` name of the email in the user's email
+        folder along with its `sender`, `subject` and `date`, so that listing
+        the inbox does not require loading the email bodies.
+
+        The entries are kept in `_inbox_cache`, so that reading an email right
+        after listing the inbox does not read the index again. The cache is
+        checked against the index's modification time and size, which also
+        catches deliveries made by other server processes.
+
+        A missing index is rebuilt from the email folder.
+        """
+        chemin_index = user_dir / gloutils.INBOX_INDEX_FILENAME
+        try:
+            st = os.stat(chemin_index)
+        except FileNotFoundError:
+            self._inbox_cache.pop(user_dir, None)
+            if not self._rebuild_inbox_index(user_dir):
+                return []
+            st = os.stat(chemin_index)
+
+        version = (st.st_mtime_ns, st.st_size)
+        cached = self._inbox_cache.get(user_dir)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        with open(chemin_index, 'r', encoding='utf-8') as f:
+            entrees = [_DEC(ligne) for ligne in f]
+        entrees.reverse()
+        self._inbox_cache[user_dir] = (version, entrees)
+        return entrees
+
+    def _rebuild_inbox_index(self, user_dir: pathlib.Path) -> bool:
+        """
+        Writes the inbox index of emails stored without one, such as those
+        delivered before the index existed, ordered by modification time.
+
+        Unreadable email files are left out. Returns False if the user has
+        no email folder.
+        """
+        dossier_email = user_dir / "email"
+        try:
+            with os.scandir(dossier_email) as it:
+                fichiers = sorted((entree.stat().st_mtime_ns, entree.name) for entree in it if entree.is_file())
+        except FileNotFoundError:
+            return False
+
+        lignes = []
+        for _, nom in fichiers:
+            try:
+                with open(dossier_email / nom, 'r', encoding='utf-8') as f:
+                    contenu = _DEC(f.read())
+                lignes.append(_ENC({"file": nom,
+                                   "sender": contenu["sender"],
+                                   "subject": contenu["subject"],
+                                   "date": contenu["date"]}) + "\n")
+            except (OSError, ValueError, KeyError, TypeError):
+                continue
+
+        # Written aside then renamed, other server processes may rebuild it too
+        chemin_index = user_dir / gloutils.INBOX_INDEX_FILENAME
+        chemin_tmp = user_dir / f"{gloutils.INBOX_INDEX_FILENAME}.{os.getpid()}.tmp"
+        try:
+            with open(chemin_tmp, 'w', encoding='utf-8') as f:
+                f.writelines(lignes)
+            os.replace(chemin_tmp, chemin_index)
+        except BaseException:
+            chemin_tmp.unlink(missing_ok=True)
+            raise
+        return True
 
     def _get_email_list(self, client_soc: socket.socket
                         ) -> gloutils.GloMessage:
@@ -214,74 +590,62 @@ class Server:
         - gloutils.GloMessage: A message containing the list of emails.
         """
 
-        nom_client = ""
-        liste_mail = []
-
-        for nom, soc in self._logged_users.items():
-            if soc == client_soc:
-                nom_client = nom
-
-        chemin_general = "{nom_dossier}/{nom_cli}".format(nom_dossier=gloutils.SERVER_DATA_DIR, nom_cli=nom_client)
-
-        # Check if the 'email' directory exists
-        if os.path.exists(chemin_general + "/email"):
-            liste = os.listdir(chemin_general + "/email")
-            for o, courr in enumerate(liste):
-                # Check if the file path exists
-                if os.path.exists(os.path.join(chemin_general + "/email", courr)):
-                    with open(chemin_general + "/email/" + courr, 'r') as f:
-                        contenu = json.load(f)
-                        info_mail = gloutils.SUBJECT_DISPLAY.format(number=str(o + 1),
-                                                                    sender=contenu["sender"],
-                                                                    subject=contenu["subject"],
-                                                                    date=contenu["date"])
-                        liste_mail.append(info_mail)
-        else:
-            # If 'email' directory does not exist, return an empty list
-            glosocket.send_msg(client_soc, json.dumps(liste_mail))
-            return gloutils.GloMessage()
+        nom_client = self._sock_to_user[client_soc]
+        afficher = gloutils.SUBJECT_DISPLAY.format
 
-        # Send the list of emails to the client
-        glosocket.send_msg(client_soc, json.dumps(liste_mail))
-        return gloutils.GloMessage()
+        # Only the inbox index is read, never the email bodies
+        liste_mail = [afficher(number=o, sender=contenu["sender"],
+                               subject=contenu["subject"], date=contenu["date"])
+                      for o, contenu in enumerate(self._read_inbox_index(self._user_dirs[nom_client]), 1)]
+
+        return gloutils.GloMessage(header=gloutils.Headers.OK,
+                                   payload=gloutils.EmailListPayload(email_list=liste_mail))
 
     def _get_email(self, client_soc: socket.socket,
                    payload: gloutils.EmailChoicePayload
-                   ) -> gloutils.GloMessage:
+                   ) -> gloutils.GloMessage | None:
         """
-        Retrieves the content of the email in the user's folder associated
+        Sends the content of the email in the user's folder associated
         with the socket.
 
         Parameters:
         - client_soc (socket.socket): The client socket associated with the user.
-        - payload (gloutils.EmailChoicePayload): Payload containing the choice of email.
+        - payload (gloutils.EmailChoicePayload): Payload containing the choice of email,
+          between 1 and the number of emails listed.
 
         Returns:
-        - gloutils.GloMessage: A message containing the content of the email.
+        - None once the email is sent, or an error message if the choice is invalid
+          or the email file no longer exists.
         """
 
-        nom_client = ''
-        for nom, soc in self._logged_users.items():
-            if soc == client_soc:
-                nom_client = nom
-
+        if not _has_fields(payload, choice=int):
+            return gloutils.GloMessage(header=gloutils.Headers.ERROR)
+        nom_client = self._sock_to_user[client_soc]
         choix = payload['choice'] - 1
-        courr = ""
 
-        chemin_general = "{nom_dossier}/{nom_cli}".format(nom_dossier=gloutils.SERVER_DATA_DIR, nom_cli=nom_client)
+        chemin_general = self._user_dirs[nom_client]
 
-        liste = os.listdir(chemin_general + "/email")
+        # Same ordering as the list sent by _get_email_list
+        entrees = self._read_inbox_index(self._user_dirs[nom_client])
+        if not 0 <= choix < len(entrees):
+            return gloutils.GloMessage(header=gloutils.Headers.ERROR)
+        courr = entrees[choix]["file"]
 
-        for o, cour in enumerate(liste):
-            if o == choix:
-                courr = cour
-
-        with open(chemin_general + "/email/" + courr, 'r') as f:
-            lr_mail = f.read()
-
-        # Send the content of the email to the client
-        glosocket.send_msg(client_soc, lr_mail)
-        return gloutils.GloMessage()
+        # Send the content of the email to the client: the length prefix goes
+        # out with the pending responses, then the kernel copies the file
+        # straight to the socket without going through Python. Exactly the
+        # announced size is sent, even if the file changes in the meantime
+        try:
+            f = open(chemin_general / "email" / courr, 'rb')
+        except FileNotFoundError:
+            return gloutils.GloMessage(header=gloutils.Headers.ERROR)
+        with f:
+            taille = os.fstat(f.fileno()).st_size
+            self._out += _LENGTH.pack(taille)
+            self._flush(client_soc)
+            if client_soc.sendfile(f, 0, taille) != taille:
+                raise glosocket.GLOSocketError("The email was not sent entirely.")
+        return None
 
     def _get_stats(self, client_soc: socket.socket) -> gloutils.GloMessage:
         """
@@ -295,90 +659,259 @@ class Server:
         - gloutils.GloMessage: A message containing the number of emails and the size.
         """
 
-        print("Afficher les statistiques:")
         nmbr_ml = 0
-        chemin_general = "{nom_dossier}/{nom_cli}".format(nom_dossier=gloutils.SERVER_DATA_DIR, nom_cli=client_soc)
-        lst = os.listdir(chemin_general + "/email")
+        tlle = 0
+        nom_client = self._sock_to_user[client_soc]
+        chemin_general = self._user_dirs[nom_client]
 
-        for i in lst:
-            nmbr_ml += 1
+        # Count the emails and sum their sizes from a single directory read
+        try:
+            with os.scandir(chemin_general / "email") as it:
+                for entree in it:
+                    if entree.is_file():
+                        nmbr_ml += 1
+                        tlle += entree.stat().st_size
+        except FileNotFoundError:
+            pass
+
+        return gloutils.GloMessage(header=gloutils.Headers.OK,
+                                   payload=gloutils.StatsPayload(count=nmbr_ml, size=tlle))
+
+    def _get_smtp(self, host: str) -> smtplib.SMTP:
+        """
+        Returns a live SMTP connection to the host, reusing the pooled one.
 
-        # Calculate the total size of the files in the email folder
-        tlle = sum(os.path.getsize(os.path.join(chemin_general + "/email", f)) for f in lst)
+        Connections are pooled per relay thread, an SMTP session being
+        sequential. The pooled connection is checked with NOOP and replaced
+        if it is dead or older than `_SMTP_MAX_AGE` seconds.
+        """
+        key = (threading.get_ident(), host)
+        with self._smtp_lock:
+            pooled = self._smtp_pool.get(key)
+        if pooled is not None:
+            conn, created_at = pooled
+            if time.monotonic() - created_at < _SMTP_MAX_AGE:
+                try:
+                    if conn.noop()[0] == 250:
+                        return conn
+                except (smtplib.SMTPException, OSError):
+                    pass
+            self._drop_smtp(key)
+
+        conn = smtplib.SMTP(host=host, timeout=10)
+        with self._smtp_lock:
+            self._smtp_pool[key] = (conn, time.monotonic())
+        return conn
+
+    def _drop_smtp(self, key: tuple[int, str]) -> None:
+        """Removes a pooled SMTP connection and closes it."""
+        with self._smtp_lock:
+            pooled = self._smtp_pool.pop(key, None)
+        if pooled is None:
+            return
+        conn = pooled[0]
+        try:
+            conn.quit()
+        except (smtplib.SMTPException, OSError):
+            conn.close()
 
-        # Send the number of emails and the total size to the client
-        glosocket.send_msg(client_soc, json.dumps({"number_of_emails": nmbr_ml, "total_size": tlle}))
-        return gloutils.GloMessage()
+    def _do_relay(self, message: EmailMessage, user_nm: str) -> None:
+        """
+        Relays an external email through the SMTP server.
 
-    def _send_email(self, payload: gloutils.EmailContentPayload) -> gloutils.GloMessage:
+        Runs in `_smtp_pool_executor`: the sender already received its
+        answer, so failures are only reported on the server.
+        """
+        key = (threading.get_ident(), gloutils.SMTP_SERVER)
+        try:
+            conc = self._get_smtp(gloutils.SMTP_SERVER)
+            conc.send_message(message)
+        except smtplib.SMTPRecipientsRefused as e:
+            print(f"Relay error for {user_nm}: {e}")
+        except smtplib.SMTPException as e:
+            self._drop_smtp(key)
+            print(f"Relay error for {user_nm}: {e}")
+        except OSError:
+            self._drop_smtp(key)
+            print(f"Relay error for {user_nm}: Echec de la connexion.")
+
+    def _send_email(self, client_soc: socket.socket,
+                    payload: gloutils.EmailContentPayload,
+                    raw_payload: str | None = None) -> gloutils.GloMessage:
         """
         Determine if the email is internal or external and:
         - If the email is internal, write the message as-is in the recipient's folder.
         - If the recipient does not exist, place the message in the SERVER_LOST_DIR folder
           and consider the sending as a failure.
         - If the recipient is external, transform the message into an EmailMessage
-          and use the SMTP server to relay it.
+          and queue it to be relayed by the SMTP server in the background.
+
+        The sender is the user associated with the client socket, and a
+        payload naming another sender is refused. When given, `raw_payload`
+        is the payload as received, stored without encoding it again.
 
         Returns a message indicating success or failure of the operation.
         """
+        if not _has_fields(payload, sender=str, destination=str, subject=str,
+                           date=str, content=str):
+            return gloutils.GloMessage(header=gloutils.Headers.ERROR)
+        nom_client = self._sock_to_user[client_soc]
+        # The payload is stored as sent, so it must name its actual sender
+        if payload["sender"] != f"{nom_client}@{gloutils.SERVER_DOMAIN}":
+            return gloutils.GloMessage(header=gloutils.Headers.ERROR)
         dest = payload["destination"]
-        user_nm = payload["sender"]
         sujet = payload["subject"]
         body = payload["content"]
 
-        message = email.message.EmailMessage()
-        dest_vl = "{nom_dossier}/{dest_}".format(nom_dossier=gloutils.SERVER_DATA_DIR, dest_=dest)
-        client_soc = self._logged_users.get(user_nm)
-
-        if client_soc:
-            if not os.path.exists(dest_vl + "/email"):
-                os.makedirs(dest_vl + "/email")
-            with open(os.path.join(dest_vl + "/email", sujet), 'w') as f:
-                f.write(json.dumps(payload))
+        dest_nm, _, domaine = dest.partition("@")
+        if raw_payload is None:
+            raw_payload = _ENC(payload)
+        # Unique per email: two emails with the same subject must not overwrite each other
+        nom_fichier = _new_email_filename()
+
+        if domaine == gloutils.SERVER_DOMAIN:
+            dest_vl = _DATA_DIR / dest_nm
+            if not dest_nm or not dest_vl.exists():
+                with open(_LOST_DIR / nom_fichier, 'w', encoding='utf-8') as f:
+                    f.write(raw_payload)
+                return gloutils.GloMessage(header=gloutils.Headers.ERROR)
+            (dest_vl / "email").mkdir(exist_ok=True)
+            with open(dest_vl / "email" / nom_fichier, 'w', encoding='utf-8') as f:
+                f.write(raw_payload)
+            # One line per email in the recipient's inbox index, which is
+            # rebuilt with this email included if it does not exist yet
+            chemin_index = dest_vl / gloutils.INBOX_INDEX_FILENAME
+            if chemin_index.exists():
+                with open(chemin_index, 'a', encoding='utf-8') as f:
+                    f.write(_ENC({"file": nom_fichier,
+                                  "sender": payload["sender"],
+                                  "subject": sujet,
+                                  "date": payload["date"]}) + "\n")
+            else:
+                self._rebuild_inbox_index(dest_vl)
+            self._inbox_cache.pop(dest_vl, None)
             return gloutils.GloMessage(header=gloutils.Headers.OK)
         else:
-            message["From"] = user_nm
+            message = email.message.EmailMessage()
+            message["From"] = f"{nom_client}@{gloutils.SERVER_DOMAIN}"
             message["To"] = dest
             message["Subject"] = sujet
             message.set_content(body)
 
-            try:
-                with smtplib.SMTP(host=gloutils.SMTP_SERVER, timeout=10) as conc:
-                    conc.send_message(message)
-                return gloutils.GloMessage(header=gloutils.Headers.OK)
-            except smtplib.SMTPException as e:
-                return gloutils.GloMessage(header=gloutils.Headers.ERROR, payload=str(e))
-            except socket.timeout:
-                return gloutils.GloMessage(header=gloutils.Headers.ERROR, payload="Echec de la connexion.")
+            # Relayed in the background so the other clients are not kept waiting
+            self._smtp_pool_executor.submit(self._do_relay, message, nom_client)
+            return gloutils.GloMessage(header=gloutils.Headers.OK)
+
+    def _h_register(self, client_soc: socket.socket, payload: gloutils.AuthPayload) -> bytes | None:
+        """Handles `AUTH_REGISTER`."""
+        return _encode(self._create_account(client_soc, payload))
+
+    def _h_login(self, client_soc: socket.socket, payload: gloutils.AuthPayload) -> bytes | None:
+        """Handles `AUTH_LOGIN`."""
+        return _encode(self._login(client_soc, payload))
+
+    def _h_logout(self, client_soc: socket.socket, payload: None) -> bytes | None:
+        """Handles `AUTH_LOGOUT`, which expects no response."""
+        self._logout(client_soc)
+        return None
+
+    def _h_bye(self, client_soc: socket.socket, payload: None) -> bytes | None:
+        """Handles `BYE`: the client is about to close its connection."""
+        self._logout(client_soc)
+        return None
+
+    def _h_inbox_request(self, client_soc: socket.socket, payload: None) -> bytes | None:
+        """Handles `INBOX_READING_REQUEST`."""
+        return _encode(self._get_email_list(client_soc))
+
+    def _h_inbox_choice(self, client_soc: socket.socket,
+                        payload: gloutils.EmailChoicePayload) -> bytes | None:
+        """Handles `INBOX_READING_CHOICE`: `_get_email` sends the email itself."""
+        resp = self._get_email(client_soc, payload)
+        return None if resp is None else _encode(resp)
+
+    def _h_email_sending(self, client_soc: socket.socket,
+                         payload: gloutils.EmailContentPayload) -> bytes | None:
+        """Handles `EMAIL_SENDING`."""
+        return _encode(self._send_email(client_soc, payload, self._raw_payload))
+
+    def _h_stats(self, client_soc: socket.socket, payload: None) -> bytes | None:
+        """Handles `STATS_REQUEST`."""
+        return _encode(self._get_stats(client_soc))
+
+    def _handle_message(self, client_soc: socket.socket, donn: str) -> bytes | None:
+        """
+        Decodes a message and dispatches it to the handler of its header.
+
+        Only authentication requests are accepted from a socket with no
+        logged user, the others are answered with an error. A malformed
+        request, or one whose payload fields do not have the expected types,
+        is also answered with an error, without affecting the other clients.
+        """
+        try:
+            header = None
+            payload = None
+            self._raw_payload = None
+            if len(donn) <= _HEADER_ONLY_MAX_LEN:
+                header = _parse_header_only(donn)
+            if header is None:
+                header, payload, self._raw_payload = _split_message(donn)
+
+            handler = self._dispatch.get(header)
+            if handler is None:
+                return None
+            if client_soc not in self._sock_to_user and header not in _UNAUTHENTICATED_HEADERS:
+                return _ERR_BYTES
+            return handler(client_soc, payload)
+        except (KeyError, ValueError, IndexError, TypeError):
+            return _ERR_BYTES
+
+    def _drain_client(self, client_soc: socket.socket, recv_buf: _RecvBuffer) -> None:
+        """
+        Handles every message pending on a client socket.
+
+        Everything the socket has ready is received into its `_RecvBuffer`,
+        then each complete message is handled. An incomplete message stays in
+        the buffer until the rest arrives.
+
+        Responses are accumulated in `_out` and sent with one `sendall` once
+        all the messages are handled. `TCP_CORK` is set in the meantime so
+        that the kernel groups the writes into full segments.
+
+        A client whose connection is closed or broken, or whose frames cannot
+        be decoded, is removed.
+        """
+        try:
+            ouvert = recv_buf.fill(client_soc)
+            _set_cork(client_soc, True)
+            for donn in recv_buf.pop_messages():
+                resp = self._handle_message(client_soc, donn)
+                if resp is not None:
+                    self._out += glosocket.pack_msg(resp)
+
+            self._flush(client_soc)
+            _set_cork(client_soc, False)
+            if not ouvert:
+                self._remove_client(client_soc)
+        except (glosocket.GLOSocketError, OSError, UnicodeDecodeError):
+            self._out.clear()
+            self._remove_client(client_soc)
+
+    def _flush(self, client_soc: socket.socket) -> None:
+        """Sends the responses pending in `_out` to the client socket."""
+        if self._out:
+            client_soc.sendall(self._out)
+            self._out.clear()
 
     def run(self):
         """Point d'entrée du serveur."""
         while True:
             try:
-                res = select.select([self._server_socket] + self._client_socs, [], [])
-                waitrs = res[0]
-
-                for soc_c in waitrs:
-                    if soc_c == self._server_socket:
+                for key, _ in self._sel.select():
+                    if key.data == "accept":
                         self._accept_client()
                     else:
-                        donn = glosocket.recv_msg(soc_c)
-                        dico = json.loads(donn)
-
-                        if dico["header"] == gloutils.Headers.AUTH_REGISTER:
-                            glosocket.send_msg(soc_c, json.dumps(self._create_account(soc_c, dico["payload"])))
-                        elif dico["header"] == gloutils.Headers.AUTH_LOGIN:
-                            glosocket.send_msg(soc_c, json.dumps(self._login(soc_c, dico["payload"])))
-                        elif dico["header"] == gloutils.Headers.AUTH_LOGOUT:
-                            glosocket.send_msg(soc_c, json.dumps(self._logout(soc_c)))
-                        elif dico["header"] == gloutils.Headers.BYE:
-                            self._logout(soc_c)
-                        elif dico["header"] == gloutils.Headers.INBOX_READING_REQUEST:
-                            glosocket.send_msg(soc_c, json.dumps(self._get_email_list(soc_c)))
-                        elif dico["header"] == gloutils.Headers.INBOX_READING_CHOICE:
-                            glosocket.send_msg(soc_c, json.dumps(self._get_email(soc_c, dico["payload"])))
-                        elif dico["header"] == gloutils.Headers.EMAIL_SENDING:
-                            glosocket.send_msg(soc_c, json.dumps(self._send_email(dico["payload"])))
+                        self._drain_client(key.fileobj, key.data)
             except KeyboardInterrupt:
                 break
             except Exception as e:
@@ -387,8 +920,8 @@ class Server:
         self.cleanup()
 
 
-def _main() -> int:
-    server = Server()
+def _serve(reuse_port: bool = False) -> int:
+    server = Server(reuse_port)
     try:
         server.run()
     except KeyboardInterrupt:
@@ -396,5 +929,56 @@ def _main() -> int:
     return 0
 
 
+def _main() -> int:
+    """
+    Starts the server in a single process by default.
+
+    With `--workers N`, starts N server processes, all listening on
+    `APP_PORT` with `SO_REUSEPORT`, and waits for them. Logged users are
+    only known to the process holding their connection, so in that mode an
+    account can be used from one session per process. Falls back to a
+    single process where `fork` or `SO_REUSEPORT` is not available.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--workers", action="store", type=int,
+                        dest="workers", default=1,
+                        help="Nombre de processus serveur (1 par défaut). "
+                             "Les sessions ne sont pas partagées entre processus.")
+    args = parser.parse_args(sys.argv[1:])
+
+    workers = args.workers
+    if workers <= 1 or not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+        return _serve()
+
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            code = _serve(reuse_port=True)
+            sys.stdout.flush()
+            os._exit(code)
+        children.append(pid)
+
+    def _stop_children(signum, frame):
+        for child in children:
+            try:
+                os.kill(child, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    # Ctrl+C reaches the whole process group, SIGTERM only this process
+    signal.signal(signal.SIGTERM, _stop_children)
+    for child in children:
+        while True:
+            try:
+                os.waitpid(child, 0)
+                break
+            except KeyboardInterrupt:
+                continue
+            except ChildProcessError:
+                break
+    return 0
+
+
 if __name__ == '__main__':
     sys.exit(_main())
@@ -34,6 +34,17 @@ def _recvall(source: socket.socket, size: int) -> bytes:
     return msg
 
 
+def pack_msg(message: str | bytes) -> bytes:
+    """
+    Encode le message et le préfixe de sa taille, tel
+    qu'attendu par recv_msg.
+
+    Un message déjà encodé en UTF-8 est préfixé tel quel.
+    """
+    data = message.encode(encoding='utf-8') if isinstance(message, str) else message
+    return struct.pack("!I", len(data)) + data
+
+
 def send_msg(dest_soc: socket.socket, message: str) -> None:
     """
     Encode le message puis le transmet à la destination.
@@ -41,10 +52,8 @@ def send_msg(dest_soc: socket.socket, message: str) -> None:
     Lève une exception GLOSocketError en cas de problème
     de communication.
     """
-    data = message.encode(encoding='utf-8')
-    data_length = struct.pack("!I", len(data))
     try:
-        dest_soc.sendall(data_length + data)
+        dest_soc.sendall(pack_msg(message))
     except OSError as ex:
         raise GLOSocketError("Cannot send data with socket") from ex
 
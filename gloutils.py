@@ -12,6 +12,7 @@ SERVER_LOST_DIR = "LOST"
 SERVER_DOMAIN = "glo2000.ca"
 SMTP_SERVER = "smtp.ulaval.ca"
 PASSWORD_FILENAME = "pass"  # nosec:B105
+INBOX_INDEX_FILENAME = "email.idx"
 
 CLIENT_AUTH_CHOICE = """Menu de connexion
 1. Créer un compte
@@ -0,0 +1,111 @@
+"""\
+Tests du découpage des messages reçus par le serveur.
+"""
+import socket
+import unittest
+
+import glosocket
+import TP4_server
+
+
+class RecvBufferTest(unittest.TestCase):
+    """Tests de `_RecvBuffer`, alimenté par une paire de sockets."""
+
+    def setUp(self) -> None:
+        self.client, self.server = socket.socketpair()
+        self.buf = TP4_server._RecvBuffer()
+
+    def tearDown(self) -> None:
+        self.client.close()
+        self.server.close()
+
+    def _receive(self) -> list[str]:
+        """Reçoit ce qui est disponible puis retourne les messages complets."""
+        self.assertTrue(self.buf.fill(self.server))
+        return self.buf.pop_messages()
+
+    def test_message_split_across_reads(self) -> None:
+        data = glosocket.pack_msg('{"header":7}')
+        self.client.sendall(data[:2])
+        self.assertEqual(self._receive(), [])
+        self.client.sendall(data[2:9])
+        self.assertEqual(self._receive(), [])
+        self.client.sendall(data[9:])
+        self.assertEqual(self._receive(), ['{"header":7}'])
+        self.assertEqual(self.buf.length, 0)
+
+    def test_header_without_body(self) -> None:
+        self.client.sendall(glosocket.pack_msg("abc")[:4])
+        self.assertEqual(self._receive(), [])
+        self.assertEqual(self.buf.length, 4)
+        self.client.sendall(b"abc")
+        self.assertEqual(self._receive(), ["abc"])
+
+    def test_several_messages_in_one_read(self) -> None:
+        messages = ["un", "deux", "é" * 10, ""]
+        partiel = glosocket.pack_msg("trois")
+        self.client.sendall(b"".join(glosocket.pack_msg(m) for m in messages) + partiel[:6])
+        self.assertEqual(self._receive(), messages)
+        self.client.sendall(partiel[6:])
+        self.assertEqual(self._receive(), ["trois"])
+
+    def test_message_larger_than_buffer(self) -> None:
+        message = "x" * (5 * TP4_server._RECV_BUF_SIZE + 123)
+        self.client.setblocking(False)
+        data = memoryview(glosocket.pack_msg(message))
+        recus = []
+        while not recus:
+            try:
+                data = data[self.client.send(data):]
+            except BlockingIOError:
+                pass
+            recus = self._receive()
+        self.assertEqual(recus, [message])
+        # The buffer returns to its initial size once the message is handled
+        self.assertEqual(len(self.buf.buf), TP4_server._RECV_BUF_SIZE)
+
+    def test_buffer_grows_with_received_data(self) -> None:
+        self.client.sendall(glosocket.pack_msg("x" * TP4_server._MAX_MSG_SIZE)[:4])
+        self.assertEqual(self._receive(), [])
+        self.assertEqual(len(self.buf.buf), TP4_server._RECV_BUF_SIZE)
+
+    def test_message_too_long(self) -> None:
+        self.client.sendall(b"\xff\xff\xff\xf0")
+        self.assertTrue(self.buf.fill(self.server))
+        with self.assertRaises(glosocket.GLOSocketError):
+            self.buf.pop_messages()
+        self.assertEqual(len(self.buf.buf), TP4_server._RECV_BUF_SIZE)
+
+    def test_closed_socket(self) -> None:
+        self.client.close()
+        self.assertFalse(self.buf.fill(self.server))
+
+
+class SplitMessageTest(unittest.TestCase):
+    """Tests de `_split_message`."""
+
+    def test_payload_text_kept(self) -> None:
+        donn = '{"header": 9, "payload": {"subject": "\\u00e9", "n": [1, 2]}}'
+        header, payload, brut = TP4_server._split_message(donn)
+        self.assertEqual(header, 9)
+        self.assertEqual(payload, {"subject": "é", "n": [1, 2]})
+        self.assertEqual(brut, '{"subject": "\\u00e9", "n": [1, 2]}')
+
+    def test_fallback_other_layout(self) -> None:
+        donn = '{"payload": {"choice": 1}, "header": 8}'
+        self.assertEqual(TP4_server._split_message(donn), (8, {"choice": 1}, None))
+
+    def test_fallback_extra_key(self) -> None:
+        donn = '{"header": 8, "payload": {"choice": 1}, "x": 0}'
+        self.assertEqual(TP4_server._split_message(donn), (8, {"choice": 1}, None))
+
+    def test_fallback_without_payload(self) -> None:
+        self.assertEqual(TP4_server._split_message('{"header": 7}'), (7, None, None))
+
+    def test_invalid_message(self) -> None:
+        with self.assertRaises(ValueError):
+            TP4_server._split_message('{"header": 9, "payload": {')
+
+
+if __name__ == '__main__':
+    unittest.main()